@@ -1,115 +1,814 @@
 import streamlit as st
+import asyncio
 import os
 import time
 import json
+import math
+import sqlite3
 import pandas as pd
 import io
+import hashlib
+import threading
+from contextlib import closing
+from datetime import datetime, timezone
 import google.generativeai as genai
+from google import genai as google_genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
+from pypdf import PdfReader
+
+from cas_numbers import drop_invalid_cas, is_cas_number, normalize_cas
+from schemas import ChemicalList, RegulatoryLimit, SdsAudit, parse_reply
 
 # 1. Config & Keys
 st.set_page_config(page_title="EHS Compliance Agent", page_icon="🛡️", layout="wide")
-load_dotenv()
 
-# Handle API Key
-api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key and "GOOGLE_API_KEY" in st.secrets:
-    api_key = st.secrets["GOOGLE_API_KEY"]
+@st.cache_resource
+def bootstrap():
+    """Load .env, resolve the API key and configure the SDK once per process, not on every rerun"""
+    load_dotenv()
+    
+    # Handle API Key
+    key = os.getenv("GOOGLE_API_KEY")
+    if not key and "GOOGLE_API_KEY" in st.secrets:
+        key = st.secrets["GOOGLE_API_KEY"]
+    
+    # REST keeps one process-wide session whose pooled keep-alive connections are
+    # shared by every model and by all the worker threads calling the sync client
+    genai.configure(api_key=key, transport="rest")
+    return key
 
-genai.configure(api_key=api_key)
+api_key = bootstrap()
 
 # --- MODEL SELECTION ---
 # We use the generic alias. This routes to the most stable 
 # free-tier model available to your specific account.
 MODEL_NAME = "gemini-flash-latest"
+# Fallbacks, in order of preference, for keys that cannot use the alias.
+MODEL_CANDIDATES = [MODEL_NAME, "gemini-2.5-flash", "gemini-2.5-flash-lite"]
+
+# Ask Gemini for a bare JSON body so replies parse without any cleanup.
+# Each call adds a response_schema from schemas.py.
+JSON_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
+# Regulatory lookups are sent one chemical per call, concurrently, capped by
+# the semaphore to stay under the Gemini rate limit. Rate-limit and server
+# errors are retried with exponential backoff.
+MAX_CONCURRENT_REQUESTS = 10
+# The cache warm-up shares that rate limit with the audit's own calls, so it
+# only gets a small slice of it.
+WARMUP_CONCURRENT_REQUESTS = 2
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+# Errors that mean the model itself is unusable, so trying another candidate helps.
+MODEL_FALLBACK_ERRORS = (
+    google_exceptions.NotFound,
+    google_exceptions.InvalidArgument,
+)
+
+# Gemini Batch Mode job states after which no more polling is needed.
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# Uploaded PDFs are polled with a backoff starting at PROCESSING_POLL_START
+# seconds; a file still processing after PROCESSING_TIMEOUT seconds is abandoned.
+PROCESSING_POLL_START = 0.1
+PROCESSING_POLL_MAX = 2.0
+PROCESSING_TIMEOUT = 60
+
+# Report columns in display order, and their on-screen / Excel headers.
+# matched_as is only filled for limits borrowed from a fuzzy name match.
+REPORT_COLUMNS = ["cas", "name", "osha_pel", "cal_pel", "cal_stel", "niosh_rel", "matched_as"]
+RENAME_MAP = {
+    "name": "Ingredient",
+    "cas": "CAS #",
+    "osha_pel": "🇺🇸 OSHA PEL",
+    "cal_pel": "🐻 Cal/OSHA PEL",
+    "cal_stel": "🚨 Cal/OSHA STEL",
+    "niosh_rel": "🔬 NIOSH REL",
+    "matched_as": "🔎 Limits matched by name to"
+}
+
+# A PDF with less extractable text than this is treated as a scanned image.
+# Gemini is slow and token-hungry on those and rarely finds the ingredients.
+MIN_PDF_TEXT_CHARS = 200
+
+# Ingredients that appear on a large share of SDSs. Their limits are warmed
+# into the cache in the background, starting when an SDS is read.
+COMMON_SDS_CHEMICALS = [
+    ("Water", "7732-18-5"),
+    ("Ethanol", "64-17-5"),
+    ("Methanol", "67-56-1"),
+    ("Isopropyl alcohol", "67-63-0"),
+    ("Acetone", "67-64-1"),
+    ("Toluene", "108-88-3"),
+    ("Xylene", "1330-20-7"),
+    ("Ethylbenzene", "100-41-4"),
+    ("n-Hexane", "110-54-3"),
+    ("n-Heptane", "142-82-5"),
+    ("Methyl ethyl ketone", "78-93-3"),
+    ("Methyl isobutyl ketone", "108-10-1"),
+    ("Ethyl acetate", "141-78-6"),
+    ("n-Butyl acetate", "123-86-4"),
+    ("2-Butoxyethanol", "111-76-2"),
+    ("Ethylene glycol", "107-21-1"),
+    ("Propylene glycol", "57-55-6"),
+    ("Diethylene glycol", "111-46-6"),
+    ("Glycerin", "56-81-5"),
+    ("Formaldehyde", "50-00-0"),
+    ("Ammonia", "7664-41-7"),
+    ("Sodium hydroxide", "1310-73-2"),
+    ("Potassium hydroxide", "1310-58-3"),
+    ("Hydrochloric acid", "7647-01-0"),
+    ("Sulfuric acid", "7664-93-9"),
+    ("Phosphoric acid", "7664-38-2"),
+    ("Nitric acid", "7697-37-2"),
+    ("Acetic acid", "64-19-7"),
+    ("Hydrogen peroxide", "7722-84-1"),
+    ("Sodium hypochlorite", "7681-52-9"),
+    ("Titanium dioxide", "13463-67-7"),
+    ("Crystalline silica (quartz)", "14808-60-7"),
+    ("Carbon black", "1333-86-4"),
+    ("Calcium carbonate", "471-34-1"),
+    ("Talc", "14807-96-6"),
+    ("Kaolin", "1332-58-7"),
+    ("Zinc oxide", "1314-13-2"),
+    ("Iron oxide", "1309-37-1"),
+    ("Aluminum oxide", "1344-28-1"),
+    ("Stoddard solvent", "8052-41-3"),
+    ("Naphthalene", "91-20-3"),
+    ("1,2,4-Trimethylbenzene", "95-63-6"),
+    ("Cyclohexane", "110-82-7"),
+    ("Dichloromethane", "75-09-2"),
+    ("Tetrachloroethylene", "127-18-4"),
+    ("Trichloroethylene", "79-01-6"),
+    ("Styrene", "100-42-5"),
+    ("n-Butanol", "71-36-3"),
+    ("Propane", "74-98-6"),
+    ("Carbon dioxide", "124-38-9"),
+]
+
+# --- REFERENCE LIMITS ---
+# OSHA Table Z-1, Cal/OSHA Table AC-1 and the NIOSH Pocket Guide, loaded into
+# SQLite by build_limits_db.py. CAS numbers found here never reach Gemini.
+REFERENCE_DB = os.getenv("REFERENCE_LIMITS_DB", "limits.db")
+
+# --- LIMITS CACHE ---
+# OSHA / Cal/OSHA / NIOSH limits are essentially static, so every lookup is
+# cached per CAS number. Chemicals without a CAS fall back to a fuzzy match
+# on the embedded ingredient name.
+LIMITS_CACHE_DB = os.getenv("LIMITS_CACHE_DB", "limits_cache.db")
+CACHE_TTL_SECONDS = 86400
+EMBEDDING_MODEL = "models/text-embedding-004"
+NAME_MATCH_THRESHOLD = 0.92
+LIMIT_FIELDS = ("osha_pel", "cal_pel", "cal_stel", "niosh_rel")
 
 # --- LOGIC ---
 
-def extract_chemicals_from_pdf(uploaded_file):
-    """Step 1: Read the PDF to get the ingredients"""
-    bytes_data = uploaded_file.getvalue()
+@st.cache_data(ttl=3600, show_spinner=False)
+def list_generation_models(api_key_hash):
+    """Models the key can generate with. Keyed on a hash of the key so rotating it refetches"""
+    return [
+        m.name.removeprefix("models/")
+        for m in genai.list_models()
+        if "generateContent" in m.supported_generation_methods
+    ]
+
+@st.cache_resource(show_spinner=False)
+def probe_working_model():
+    """One-time health check: the first candidate this API key can generate with"""
+    try:
+        available = set(list_generation_models(hashlib.sha256((api_key or "").encode()).hexdigest()))
+    except Exception:
+        return MODEL_NAME
     
-    with open("temp.pdf", "wb") as f:
-        f.write(bytes_data)
-        
-    status_text = st.empty()
-    status_text.write(f"🚀 Reading SDS using {MODEL_NAME}...")
+    for candidate in MODEL_CANDIDATES:
+        if candidate in available:
+            return candidate
+    return MODEL_NAME
+
+@st.cache_resource(show_spinner=False)
+def get_model(model_name):
+    """One shared GenerativeModel per name, reused across calls, sessions and reruns"""
+    return genai.GenerativeModel(model_name, generation_config=JSON_GENERATION_CONFIG)
+
+async def generate_with_model(model_name, contents, schema, progress=None):
+    """One structured Gemini call. Given a progress placeholder, the reply is streamed into it.
     
-    g_file = genai.upload_file(path="temp.pdf", display_name="SDS")
+    The SDK's async client is bound to the first event loop it ran on, and every
+    asyncio.run() in the UI makes a new loop, so the sync client is driven from
+    worker threads instead."""
+    model = get_model(model_name)
+    generation_config = {**JSON_GENERATION_CONFIG, "response_schema": schema}
+    if progress is None:
+        response = await asyncio.to_thread(model.generate_content, contents, generation_config=generation_config)
+        return response.text
     
-    # Wait for processing
+    response = await asyncio.to_thread(model.generate_content, contents, generation_config=generation_config, stream=True)
+    chunks = iter(response)
+    received = 0
+    # Pull each chunk in a worker thread, but write progress from the script thread
+    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+        received += len(chunk.text)
+        progress.write(f"📡 Received {received} chars...")
+    response.resolve()
+    return response.text
+
+async def generate_content_safe(contents, schema, progress=None):
+    """Generate with the probed model, walking the other candidates only if that model is unusable.
+    Rate-limit and server errors propagate untouched so the caller can back off.
+    Returns the reply parsed for the given response_schema, as plain dicts"""
+    model_name = probe_working_model()
+    try:
+        raw_text = await generate_with_model(model_name, contents, schema, progress)
+        return parse_reply(schema, raw_text)
+    except MODEL_FALLBACK_ERRORS as e:
+        # The probed model went bad; forget it so the next call re-probes
+        probe_working_model.clear()
+        last_error = e
+    
+    for candidate in MODEL_CANDIDATES:
+        if candidate == model_name:
+            continue
+        try:
+            raw_text = await generate_with_model(candidate, contents, schema, progress)
+            return parse_reply(schema, raw_text)
+        except MODEL_FALLBACK_ERRORS as e:
+            last_error = e
+    raise last_error
+
+def wait_until_active(g_file):
+    """Poll with exponential backoff until Gemini has finished processing an upload"""
+    delay = PROCESSING_POLL_START
+    deadline = time.monotonic() + PROCESSING_TIMEOUT
     while g_file.state.name == "PROCESSING":
-        time.sleep(1)
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Gemini is still processing {g_file.name} after {PROCESSING_TIMEOUT}s")
+        time.sleep(delay)
+        delay = min(delay * 1.5, PROCESSING_POLL_MAX)
         g_file = genai.get_file(g_file.name)
+    
+    if g_file.state.name == "FAILED":
+        raise RuntimeError(f"Gemini could not process {g_file.name}")
+    return g_file
+
+def upload_sds(bytes_data):
+    """Upload an SDS and wait until Gemini has processed it"""
+    # Upload straight from memory: no shared temp file to race on between sessions
+    g_file = genai.upload_file(path=io.BytesIO(bytes_data), display_name="SDS", mime_type="application/pdf")
+    return wait_until_active(g_file)
+
+@st.cache_resource(show_spinner=False)
+def sds_upload_slot(digest):
+    """Per-content-hash holder for the remote file name, so one expired upload can be replaced alone"""
+    return {"name": None, "lock": threading.Lock()}
+
+def get_sds_file(bytes_data):
+    """Gemini file handle for this SDS, uploading once per content hash and again only if it expired"""
+    slot = sds_upload_slot(hashlib.sha256(bytes_data).hexdigest())
+    with slot["lock"]:
+        if slot["name"] is not None:
+            try:
+                return genai.get_file(slot["name"])
+            except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+                # Gemini deletes uploads after 48 hours
+                slot["name"] = None
         
-    model = genai.GenerativeModel(MODEL_NAME)
-    prompt = """
+        g_file = upload_sds(bytes_data)
+        slot["name"] = g_file.name
+        return g_file
+
+EXTRACTION_PROMPT = """
     You are an AI Robot that extracts data.
     1. Look at Section 3 (Composition) of this SDS.
     2. Extract EVERY chemical ingredient listed.
     3. Return ONLY valid JSON: {'chemicals': [{'name': 'Chemical Name', 'cas': '00-00-0'}]}
     """
+
+# Extraction and regulatory lookup fused into one call on the uploaded file,
+# saving a round-trip. get_regulatory_limits only fills in what this misses.
+EXTRACTION_WITH_LIMITS_PROMPT = """
+    You are a Certified Industrial Hygienist (CIH) reading a Safety Data Sheet.
+    1. Look at Section 3 (Composition) of this SDS.
+    2. Extract EVERY chemical ingredient listed.
+    3. For each ingredient, retrieve limits from THREE specific sources:
+       - **Federal OSHA** (29 CFR 1910.1000 Table Z-1).
+       - **Cal/OSHA** (Title 8 Section 5155 Table AC-1).
+       - **NIOSH** (NIOSH Pocket Guide).
+    
+    CRITICAL RULES:
+    - **Do NOT substitute data.** If Cal/OSHA has no limit, write "None Listed". Do NOT use the NIOSH limit to fill the gap.
+    - Be precise with "Skin" notations.
+    - Return ONLY valid JSON:
+    {
+      "chemicals": [{"name": "Chemical Name", "cas": "00-00-0"}],
+      "limits": [
+        {
+          "cas": "00-00-0",
+          "name": "Chemical Name",
+          "osha_pel": "Value or 'None'",
+          "cal_pel": "Value or 'None'",
+          "cal_stel": "Value or 'None'",
+          "niosh_rel": "Value or 'None'"
+        }
+      ]
+    }
+    """
+
+class ScannedPdfError(Exception):
+    """The SDS has no text layer; raised before anything is uploaded"""
+
+@st.cache_data(show_spinner=False)
+def count_pdf_text_chars(digest, _bytes_data):
+    """Characters of extractable text across all pages, cached per content hash"""
+    reader = PdfReader(io.BytesIO(_bytes_data))
+    return sum(len(page.extract_text() or "") for page in reader.pages)
+
+def is_scanned_pdf(bytes_data):
+    """True for image-only PDFs. Unreadable files get the benefit of the doubt"""
+    try:
+        text_chars = count_pdf_text_chars(hashlib.sha256(bytes_data).hexdigest(), bytes_data)
+    except Exception:
+        return False
+    return text_chars < MIN_PDF_TEXT_CHARS
+
+async def extract_chemicals_from_pdf(uploaded_file, with_limits=True):
+    """Step 1: Read the PDF to get the ingredients (and, by default, their limits)"""
+    bytes_data = uploaded_file.getvalue()
+    
+    # Refuse scanned SDSs locally rather than paying for an upload + generate
+    if is_scanned_pdf(bytes_data):
+        raise ScannedPdfError("Scanned PDF — no text layer found. Please OCR it first.")
+        
+    status_text = st.empty()
+    status_text.write(f"🚀 Reading SDS using {probe_working_model()}...")
+    
+    # The upload and processing wait block, so keep them off the event loop
+    g_file = await asyncio.to_thread(get_sds_file, bytes_data)
+        
+    if with_limits:
+        prompt, schema = EXTRACTION_WITH_LIMITS_PROMPT, SdsAudit
+    else:
+        prompt, schema = EXTRACTION_PROMPT, ChemicalList
     
     try:
-        response = model.generate_content([g_file, prompt])
-        clean_json = response.text.replace("```json", "").replace("```", "").strip()
-        return json.loads(clean_json)
+        data = await generate_content_safe([g_file, prompt], schema, progress=status_text)
     except Exception as e:
         st.error(f"AI Error: {e}")
         return {"chemicals": []}
+    
+    data, invalid = drop_invalid_cas(data)
+    if invalid:
+        st.warning("Skipped ingredients with an invalid CAS number: " + ", ".join(
+            f"{chem.get('name')} ({chem.get('cas')})" for chem in invalid
+        ))
+    return data
+
+def chemical_key(chem):
+    """Identity of an ingredient row: its CAS number, or its name when there is none"""
+    if is_cas_number(chem.get("cas")):
+        return chem["cas"]
+    return (chem.get("name") or "").strip().lower()
+
+def dedupe_chemicals(chemicals_list):
+    """Normalize CAS numbers and collapse synonym rows that share one.
+    Returns (normalized rows, unique rows)"""
+    normalized = [{**chem, "cas": normalize_cas(chem.get("cas"))} for chem in chemicals_list]
+    unique = list({chemical_key(chem): chem for chem in normalized}.values())
+    return normalized, unique
+
+def join_limits(chemicals_list, limit_rows):
+    """Left-join limit rows back onto the original (possibly duplicated) ingredient rows"""
+    by_cas = {normalize_cas(row.get("cas")): row for row in limit_rows if is_cas_number(normalize_cas(row.get("cas")))}
+    by_name = {(row.get("name") or "").strip().lower(): row for row in limit_rows}
+    
+    joined = []
+    for chem in chemicals_list:
+        row = by_cas.get(chem["cas"]) if is_cas_number(chem.get("cas")) else None
+        row = row or by_name.get((chem.get("name") or "").strip().lower(), {})
+        joined.append({**row, "name": chem.get("name") or row.get("name"), "cas": chem.get("cas") or row.get("cas")})
+    return joined
+
+def connect_limits_cache():
+    """Open the SQLite limits cache, creating the table on first use"""
+    conn = sqlite3.connect(LIMITS_CACHE_DB)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS limits (
+            cas TEXT PRIMARY KEY,
+            name TEXT,
+            osha_pel TEXT,
+            cal_pel TEXT,
+            cal_stel TEXT,
+            niosh_rel TEXT,
+            name_embedding TEXT,
+            fetched_at TEXT,
+            source TEXT
+        )
+    """)
+    # Caches created before the source column existed
+    if "source" not in {column["name"] for column in conn.execute("PRAGMA table_info(limits)")}:
+        conn.execute("ALTER TABLE limits ADD COLUMN source TEXT")
+    return conn
+
+@st.cache_resource
+def connect_reference_limits():
+    """Read-only connection to the shipped reference table, or None if it is absent"""
+    if not os.path.exists(REFERENCE_DB):
+        return None
+    conn = sqlite3.connect(f"file:{REFERENCE_DB}?mode=ro", uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def read_reference_limits(cas_numbers):
+    """Reference limits for the given CAS numbers, as {cas: row}"""
+    conn = connect_reference_limits()
+    if conn is None or not cas_numbers:
+        return {}
+    placeholders = ", ".join("?" * len(cas_numbers))
+    rows = conn.execute(
+        f"SELECT cas, name, osha_pel, cal_pel, cal_stel, niosh_rel FROM limits WHERE cas IN ({placeholders})",
+        list(cas_numbers),
+    ).fetchall()
+    return {row["cas"]: dict(row) for row in rows}
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def read_cached_limits(cas):
+    """In-process layer over the SQLite cache. Misses raise KeyError so they are never memoized"""
+    with closing(connect_limits_cache()) as conn:
+        row = conn.execute(
+            "SELECT cas, name, osha_pel, cal_pel, cal_stel, niosh_rel FROM limits WHERE cas = ?",
+            (cas,),
+        ).fetchone()
+    if row is None:
+        raise KeyError(cas)
+    return dict(row)
+
+def embed_names(names):
+    """Embed ingredient names for fuzzy matching"""
+    return genai.embed_content(model=EMBEDDING_MODEL, content=names)["embedding"]
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def match_cached_names(chemicals_list):
+    """Find the closest cached entry for each CAS-less chemical, or None below the threshold"""
+    with closing(connect_limits_cache()) as conn:
+        rows = conn.execute(
+            "SELECT cas, name, osha_pel, cal_pel, cal_stel, niosh_rel, name_embedding "
+            "FROM limits WHERE name_embedding IS NOT NULL"
+        ).fetchall()
+    if not rows:
+        return [None] * len(chemicals_list)
+    
+    candidates = [
+        ({key: row[key] for key in row.keys() if key != "name_embedding"}, json.loads(row["name_embedding"]))
+        for row in rows
+    ]
+    matches = []
+    for query in embed_names([chem.get("name", "") for chem in chemicals_list]):
+        best_row, best_score = None, NAME_MATCH_THRESHOLD
+        for row, embedding in candidates:
+            score = cosine_similarity(query, embedding)
+            if score >= best_score:
+                best_row, best_score = row, score
+        matches.append(best_row)
+    return matches
+
+def split_cached_limits(chemicals_list):
+    """Partition chemicals into (cached limit rows, chemicals still to look up)"""
+    cached, missing, unidentified = [], [], []
+    for chem in chemicals_list:
+        cas = normalize_cas(chem.get("cas"))
+        if not is_cas_number(cas):
+            unidentified.append(chem)
+            continue
+        try:
+            cached.append(read_cached_limits(cas))
+        except KeyError:
+            missing.append(chem)
+    
+    if unidentified:
+        try:
+            matches = match_cached_names(unidentified)
+        except Exception:
+            matches = [None] * len(unidentified)
+        for chem, match in zip(unidentified, matches):
+            if match:
+                # Joined onto the SDS row by its own name and CAS, but these are another
+                # entry's limits, so say which one instead of passing them off as its own
+                cached.append({
+                    **match,
+                    "name": chem.get("name"),
+                    "cas": chem.get("cas"),
+                    "matched_as": f"{match['name'] or 'Unnamed'} (CAS {match['cas']})",
+                    "source": "fuzzy",
+                })
+            else:
+                missing.append(chem)
+    return cached, missing
+
+def is_complete_limit(row):
+    """A limit row Gemini filled in for every agency (None means the field was omitted)"""
+    return isinstance(row, dict) and all(row.get(field) is not None for field in LIMIT_FIELDS)
 
-def get_regulatory_limits(chemicals_list):
-    """Step 2: Strict Lookup for OSHA, Cal/OSHA, and NIOSH"""
-    model = genai.GenerativeModel(MODEL_NAME)
+def store_limits(rows, source="gemini"):
+    """UPSERT freshly retrieved limits into the cache, tagged with where they came from.
+    Incomplete rows are still shown to the user but never cached"""
+    rows = [{**row, "cas": normalize_cas(row.get("cas"))} for row in rows if is_complete_limit(row)]
+    rows = [row for row in rows if is_cas_number(row["cas"])]
+    if not rows:
+        return
+    
+    try:
+        embeddings = [json.dumps(e) for e in embed_names([row.get("name") or row["cas"] for row in rows])]
+    except Exception:
+        # The limits are still worth caching by CAS without the fuzzy-match vector
+        embeddings = [None] * len(rows)
     
-    prompt = f"""
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    with closing(connect_limits_cache()) as conn, conn:
+        conn.executemany("""
+            INSERT INTO limits (cas, name, osha_pel, cal_pel, cal_stel, niosh_rel, name_embedding, fetched_at, source)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(cas) DO UPDATE SET
+                name = excluded.name,
+                osha_pel = excluded.osha_pel,
+                cal_pel = excluded.cal_pel,
+                cal_stel = excluded.cal_stel,
+                niosh_rel = excluded.niosh_rel,
+                name_embedding = COALESCE(excluded.name_embedding, limits.name_embedding),
+                fetched_at = excluded.fetched_at,
+                source = excluded.source
+        """, [
+            (
+                row["cas"], row.get("name"),
+                row.get("osha_pel"), row.get("cal_pel"), row.get("cal_stel"), row.get("niosh_rel"),
+                embedding, fetched_at, source,
+            )
+            for row, embedding in zip(rows, embeddings)
+        ])
+
+def build_regulatory_prompt(chem):
+    """Compact prompt for the strict OSHA / Cal/OSHA / NIOSH lookup of one chemical"""
+    return f"""
     You are a Certified Industrial Hygienist (CIH).
     
-    For the chemicals below, retrieve limits from THREE specific sources:
+    For {chem.get("name") or "this chemical"} (CAS {chem.get("cas") or "unknown"}), retrieve limits from THREE specific sources:
     1. **Federal OSHA** (29 CFR 1910.1000 Table Z-1).
     2. **Cal/OSHA** (Title 8 Section 5155 Table AC-1).
     3. **NIOSH** (NIOSH Pocket Guide).
     
-    Chemical List:
-    {json.dumps(chemicals_list)}
-    
     CRITICAL RULES:
     - **Do NOT substitute data.** If Cal/OSHA has no limit, write "None Listed". Do NOT use the NIOSH limit to fill the gap.
     - Be precise with "Skin" notations.
     - Return strictly formatted JSON:
-    [
-      {{
-        "cas": "00-00-0",
-        "name": "Chemical Name",
-        "osha_pel": "Value or 'None'",
-        "cal_pel": "Value or 'None'",
-        "cal_stel": "Value or 'None'",
-        "niosh_rel": "Value or 'None'"
-      }}
-    ]
+    {{
+      "cas": "00-00-0",
+      "name": "Chemical Name",
+      "osha_pel": "Value or 'None'",
+      "cal_pel": "Value or 'None'",
+      "cal_stel": "Value or 'None'",
+      "niosh_rel": "Value or 'None'"
+    }}
     """
+
+async def lookup_one(chem, semaphore, show_errors=True):
+    """Look up one chemical; a failed chemical does not sink the others"""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with semaphore:
+                return [await generate_content_safe(build_regulatory_prompt(chem), RegulatoryLimit)]
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                if show_errors:
+                    st.error(f"Regulatory Lookup Error ({chem.get('name')}): {e}")
+                return []
+            await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+        except Exception as e:
+            if show_errors:
+                st.error(f"Regulatory Lookup Error ({chem.get('name')}): {e}")
+            return []
+
+def resolve_known_limits(chemicals_list, known_limits=()):
+    """Dedupe the ingredients and resolve whatever does not need a Gemini lookup.
+    Returns (normalized rows, resolved limit rows, chemicals still missing)"""
+    chemicals_list, unique = dedupe_chemicals(chemicals_list)
+    
+    # The published tables win over anything Gemini said about the same CAS
+    reference = read_reference_limits([chem["cas"] for chem in unique if is_cas_number(chem["cas"])])
+    unique = [chem for chem in unique if chem["cas"] not in reference]
     
+    # Rows from the fused extraction prompt count only if they are complete
+    if not isinstance(known_limits, list):
+        known_limits = []
+    known = [
+        row for row in known_limits
+        if is_complete_limit(row)
+        and normalize_cas(row.get("cas")) not in reference
+    ]
+    store_limits(known)
+    covered = {chemical_key({**row, "cas": normalize_cas(row.get("cas"))}) for row in known}
+    covered |= {(row.get("name") or "").strip().lower() for row in known}
+    
+    cached, missing = split_cached_limits([chem for chem in unique if chemical_key(chem) not in covered])
+    return chemicals_list, known + cached + list(reference.values()), missing
+
+async def get_regulatory_limits(chemicals_list, known_limits=(), live_table=None, show_errors=True,
+                                max_concurrent=MAX_CONCURRENT_REQUESTS):
+    """Step 2: Strict Lookup for OSHA, Cal/OSHA, and NIOSH.
+    Rows are shown in the optional live_table placeholder as each one lands"""
+    chemicals_list, resolved, missing = resolve_known_limits(chemicals_list, known_limits)
+    if not missing:
+        return join_limits(chemicals_list, resolved)
+    
+    semaphore = asyncio.Semaphore(max_concurrent)
+    
+    tasks = [asyncio.create_task(lookup_one(chem, semaphore, show_errors)) for chem in missing]
+    fetched = []
     try:
-        response = model.generate_content(prompt)
-        clean_text = response.text.replace("```json", "").replace("```", "").strip()
-        return json.loads(clean_text)
-    except Exception as e:
-        st.error(f"Regulatory Lookup Error: {e}")
-        return []
+        for next_lookup in asyncio.as_completed(tasks):
+            fetched.extend(await next_lookup)
+            if live_table is not None:
+                live_table.dataframe(build_report_frame(resolved + fetched))
+    finally:
+        # If we were cancelled part-way, stop the rest but keep what already landed
+        for task in tasks:
+            task.cancel()
+        store_limits(fetched)
+    return join_limits(chemicals_list, resolved + fetched)
+
+def preload_common_limits():
+    """Warm the limits cache with COMMON_SDS_CHEMICALS; a no-op once they are cached"""
+    chemicals = [{"name": name, "cas": cas} for name, cas in COMMON_SDS_CHEMICALS]
+    try:
+        asyncio.run(get_regulatory_limits(chemicals, show_errors=False, max_concurrent=WARMUP_CONCURRENT_REQUESTS))
+    except Exception:
+        # Only a warm-up; the audit itself looks up anything still missing
+        pass
+
+@st.cache_resource
+def warmup_lock():
+    """Held while a warm-up runs, so sessions and reruns never start a second one"""
+    return threading.Lock()
+
+def start_cache_warmup():
+    """Run preload_common_limits on a daemon thread with its own event loop.
+    Nothing joins it: results are cached when they land and the audit never waits"""
+    lock = warmup_lock()
+    if not lock.acquire(blocking=False):
+        return
+    
+    def run():
+        try:
+            preload_common_limits()
+        finally:
+            lock.release()
+    
+    threading.Thread(target=run, name="limits-warmup", daemon=True).start()
+
+async def read_sds(uploaded_file):
+    """Step 1, kicking off the cache warm-up in the background"""
+    # A scanned PDF is rejected without an upload, so it is not worth warming for
+    if not is_scanned_pdf(uploaded_file.getvalue()):
+        start_cache_warmup()
+    return await extract_chemicals_from_pdf(uploaded_file)
+
+# --- BATCH MODE ---
+# Offline audits go through Gemini Batch Mode: about half the price of
+# interactive calls, at the cost of results arriving minutes to hours later.
+
+@st.cache_resource
+def get_batch_client():
+    """Client for the google-genai SDK, which is the one exposing batches"""
+    return google_genai.Client(api_key=api_key)
+
+def schedule_batch_audit(chemicals_list):
+    """Queue the regulatory lookup as one inline request per chemical; returns the job name"""
+    inline_requests = [
+        {
+            "contents": [{"role": "user", "parts": [{"text": build_regulatory_prompt(chem)}]}],
+            "config": {**JSON_GENERATION_CONFIG, "response_schema": RegulatoryLimit},
+        }
+        for chem in chemicals_list
+    ]
+    job = get_batch_client().batches.create(
+        model=probe_working_model(),
+        src=inline_requests,
+        config={"display_name": "sds-regulatory-audit"},
+    )
+    return job.name
+
+def collect_batch_audit(job_name):
+    """Poll a batch job once. Returns (state, rows); rows is None while still running"""
+    job = get_batch_client().batches.get(name=job_name)
+    state = job.state.name
+    if state not in BATCH_DONE_STATES:
+        return state, None
+    
+    rows = []
+    if state == "JOB_STATE_SUCCEEDED":
+        for inline_response in job.dest.inlined_responses:
+            if inline_response.error:
+                st.error(f"Batch Lookup Error: {inline_response.error}")
+                continue
+            try:
+                rows.append(parse_reply(RegulatoryLimit, inline_response.response.text))
+            except Exception as e:
+                st.error(f"Batch Lookup Error: {e}")
+        store_limits(rows)
+    return state, rows
+
+def build_report_frame(regulatory_data):
+    """Turn limit rows into the display / export table"""
+    # Fixed column order regardless of how Gemini ordered the JSON keys
+    df = pd.DataFrame.from_records(regulatory_data, columns=REPORT_COLUMNS)
+    df = df.astype({"cas": "string", "name": "string"})
+    if df["matched_as"].isna().all():
+        df = df.drop(columns="matched_as")
+    
+    # RENAME COLUMNS
+    return df.rename(columns=RENAME_MAP)
+
+def build_excel_report(df):
+    """Excel export. Only built on request, so xlsxwriter stays out of the common path"""
+    buffer = io.BytesIO()
+    # No constant_memory: pandas writes column by column, and that mode drops
+    # cells for rows it has already flushed
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        writer.book.use_zip64()
+        df.to_excel(writer, index=False, sheet_name='Safety_Data')
+    return buffer.getvalue()
+
+def render_report(df, key="audit"):
+    """Show the limits table and offer it as a CSV (or, on request, Excel) download"""
+    # Display the table
+    st.table(df)
+    
+    # --- DOWNLOAD LOGIC ---
+    csv_buffer = io.StringIO()
+    df.to_csv(csv_buffer, index=False)
+    st.download_button(
+        label="📥 Download CSV Report",
+        # BOM so Excel reads the emoji headers as UTF-8
+        data=csv_buffer.getvalue().encode("utf-8-sig"),
+        file_name="safety_audit.csv",
+        mime="text/csv",
+        key=f"{key}_csv"
+    )
+    
+    with st.expander("Excel report"):
+        if st.button("Prepare Excel workbook", key=f"{key}_prepare_xlsx"):
+            st.session_state[f"{key}_xlsx"] = build_excel_report(df)
+        
+        if st.session_state.get(f"{key}_xlsx") is not None:
+            st.download_button(
+                label="📥 Download Excel Report",
+                data=st.session_state[f"{key}_xlsx"],
+                file_name="safety_audit.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"{key}_excel"
+            )
+
+def save_audit(audit_key, regulatory_data):
+    """Keep a finished audit in session_state so reruns (e.g. the download click) reuse it"""
+    st.session_state["audit_df"] = build_report_frame(regulatory_data)
+    st.session_state["audit_key"] = audit_key
+    # Any workbook prepared for a previous audit is stale now
+    st.session_state.pop("audit_xlsx", None)
 
 # --- UI ---
+if st.sidebar.button("Refresh models", help="Re-list the Gemini models available to this API key."):
+    list_generation_models.clear()
+    probe_working_model.clear()
+
 st.title("🛡️ EHS Compliance Agent")
 st.markdown("### Regulatory Cross-Reference (OSHA vs. Cal/OSHA vs. NIOSH)")
-st.caption(f"Powered by **{MODEL_NAME}** (Stable Channel)")
+st.caption(f"Powered by **{probe_working_model()}** (Stable Channel)")
 
 uploaded_file = st.file_uploader("Upload SDS (PDF)", type=["pdf"])
 
 if uploaded_file:
-    if st.button("Audit Mixture"):
+    audit_key = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    already_audited = st.session_state.get("audit_key") == audit_key
+    
+    col_audit, col_batch = st.columns(2)
+    audit_clicked = col_audit.button("Audit Mixture")
+    batch_clicked = col_batch.button("Schedule batch audit", help="Cheaper, but results can take a while to arrive.")
+    
+    # Re-clicking on an SDS that was just audited only re-renders the saved result
+    if audit_clicked and not already_audited:
         try:
             # PHASE 1: READ PDF
             with st.spinner("Step 1: Reading PDF composition..."):
-                data = extract_chemicals_from_pdf(uploaded_file)
+                data = asyncio.run(read_sds(uploaded_file))
                 compounds = data.get('chemicals', [])
                 
                 if not compounds:
@@ -120,35 +819,70 @@ if uploaded_file:
             # PHASE 2: LOOKUP LIMITS
             if compounds:
                 with st.spinner("Step 2: Separating Agency Data..."):
-                    regulatory_data = get_regulatory_limits(compounds)
+                    live_table = st.empty()
+                    regulatory_data = asyncio.run(get_regulatory_limits(compounds, data.get('limits'), live_table))
+                    live_table.empty()
                     
                     if regulatory_data:
-                        df = pd.DataFrame(regulatory_data)
-                        
-                        # RENAME COLUMNS
-                        df = df.rename(columns={
-                            "name": "Ingredient",
-                            "cas": "CAS #",
-                            "osha_pel": "🇺🇸 OSHA PEL",
-                            "cal_pel": "🐻 Cal/OSHA PEL",
-                            "cal_stel": "🚨 Cal/OSHA STEL",
-                            "niosh_rel": "🔬 NIOSH REL"
-                        })
-                        
-                        # Display the table
-                        st.table(df)
-                        
-                        # --- EXCEL DOWNLOAD LOGIC ---
-                        buffer = io.BytesIO()
-                        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                            df.to_excel(writer, index=False, sheet_name='Safety_Data')
-                        
-                        st.download_button(
-                            label="📥 Download Excel Report",
-                            data=buffer.getvalue(),
-                            file_name="safety_audit.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                        )
+                        save_audit(audit_key, regulatory_data)
                     
+        except ScannedPdfError as e:
+            st.error(str(e))
         except Exception as e:
             st.error(f"System Error: {e}")
+    
+    if batch_clicked and not already_audited:
+        try:
+            with st.spinner("Step 1: Reading PDF composition..."):
+                # Batch jobs are for the cheap path, so only extract here
+                data = asyncio.run(extract_chemicals_from_pdf(uploaded_file, with_limits=False))
+                compounds = data.get('chemicals', [])
+            
+            compounds, cached, missing = resolve_known_limits(compounds)
+            if not compounds:
+                st.warning("No chemicals found or AI blocked the file.")
+            elif not missing:
+                # Everything is already cached; no point in queueing a job
+                save_audit(audit_key, join_limits(compounds, cached))
+            else:
+                st.session_state["batch_job"] = schedule_batch_audit(missing)
+                st.session_state["batch_compounds"] = compounds
+                st.session_state["batch_cached"] = cached
+                st.success(f"Found {len(compounds)} ingredients ({len(cached)} cached). Batch audit scheduled.")
+        except ScannedPdfError as e:
+            st.error(str(e))
+        except Exception as e:
+            st.error(f"System Error: {e}")
+    
+    if st.session_state.get("audit_key") == audit_key and st.session_state.get("audit_df") is not None:
+        render_report(st.session_state["audit_df"])
+
+# --- BATCH AUDIT ---
+if "batch_job" in st.session_state:
+    st.divider()
+    st.markdown(f"**Batch audit:** `{st.session_state['batch_job']}`")
+    
+    if st.button("Check batch status"):
+        try:
+            state, regulatory_data = collect_batch_audit(st.session_state["batch_job"])
+            if regulatory_data is None:
+                st.info(f"Still running ({state}). Check back later.")
+            else:
+                del st.session_state["batch_job"]
+                compounds = st.session_state.pop("batch_compounds", [])
+                cached = st.session_state.pop("batch_cached", [])
+                # Check before joining: the join yields a (blank) row per compound regardless
+                if state != "JOB_STATE_SUCCEEDED":
+                    st.error(f"Batch audit did not complete ({state}). Please schedule it again.")
+                elif not regulatory_data:
+                    st.warning(f"Batch audit finished without results ({state}).")
+                else:
+                    st.session_state["batch_df"] = build_report_frame(join_limits(compounds, cached + regulatory_data))
+                    st.session_state.pop("batch_xlsx", None)
+        except Exception as e:
+            st.error(f"System Error: {e}")
+
+if st.session_state.get("batch_df") is not None:
+    st.divider()
+    st.markdown("**Batch audit results**")
+    render_report(st.session_state["batch_df"], key="batch")
@@ -0,0 +1,54 @@
+"""Build the reference limits table (limits.db) used by app.py.
+
+The input is a CSV compiled from the three published sources, one row per CAS:
+    cas,name,osha_pel,cal_pel,cal_stel,niosh_rel
+Use "None Listed" where an agency has no limit, same as the app's prompts.
+
+Usage:
+    python build_limits_db.py reference_limits.csv [--db limits.db]
+"""
+import argparse
+import csv
+import sqlite3
+from contextlib import closing
+
+from cas_numbers import is_cas_number, normalize_cas
+
+COLUMNS = ["cas", "name", "osha_pel", "cal_pel", "cal_stel", "niosh_rel"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv_path", help="CSV export of OSHA Z-1 / Cal/OSHA AC-1 / NIOSH limits")
+    parser.add_argument("--db", default="limits.db", help="SQLite file to (re)build")
+    args = parser.parse_args()
+
+    rows, rejected = [], []
+    with open(args.csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            # Same canonical form app.py looks CAS numbers up with
+            cas = normalize_cas(row.get("cas"))
+            if not is_cas_number(cas):
+                rejected.append(cas)
+                continue
+            rows.append((cas, *((row.get(column) or "").strip() for column in COLUMNS[1:])))
+
+    with closing(sqlite3.connect(args.db)) as conn, conn:
+        conn.execute("DROP TABLE IF EXISTS limits")
+        conn.execute("""
+            CREATE TABLE limits (
+                cas TEXT PRIMARY KEY,
+                name TEXT,
+                osha_pel TEXT,
+                cal_pel TEXT,
+                cal_stel TEXT,
+                niosh_rel TEXT
+            )
+        """)
+        conn.executemany("INSERT OR REPLACE INTO limits VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    print(f"Wrote {len({row[0] for row in rows})} reference rows to {args.db}")
+    if rejected:
+        print(f"Skipped {len(rejected)} rows without a valid CAS number: " + ", ".join(repr(cas) for cas in rejected))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""CAS Registry Number helpers: normalization and checksum validation.
+
+Kept free of Streamlit / Gemini imports so they can be unit tested on their own.
+"""
+import re
+
+CAS_PATTERN = re.compile(r"\d{2,7}-\d{2}-\d")
+
+def normalize_cas(cas):
+    """Canonical CAS form (e.g. ' 0007732 18 5' -> '7732-18-5'); non-CAS text is only trimmed"""
+    cas = (cas or "").strip()
+    match = re.fullmatch(r"0*(\d{2,7})-?(\d{2})-?(\d)", "".join(cas.split()))
+    if not match:
+        return cas
+    return "-".join(match.groups())
+
+def has_valid_check_digit(cas):
+    """CAS checksum: the last digit is sum(position * digit) % 10 over the others, read right to left"""
+    digits = cas.replace("-", "")
+    return int(digits[-1]) == sum(i * int(d) for i, d in enumerate(reversed(digits[:-1]), 1)) % 10
+
+def is_cas_number(cas):
+    """True for a valid normalized CAS number, False for 'Trade Secret', 'Mixture', blanks...
+    All-zero numbers such as the prompts' '00-00-0' placeholder pass the checksum but are never real"""
+    return (
+        bool(CAS_PATTERN.fullmatch(cas or ""))
+        and has_valid_check_digit(cas)
+        and bool(cas.replace("-", "").strip("0"))
+    )
+
+def is_hallucinated_cas(cas):
+    """Shaped like a CAS number but not a valid one, so it cannot be a real substance"""
+    cas = normalize_cas(cas)
+    return bool(CAS_PATTERN.fullmatch(cas)) and not is_cas_number(cas)
+
+def drop_invalid_cas(data):
+    """Remove extracted rows whose CAS is invalid before anything is looked up.
+    Returns (data, dropped ingredient rows)"""
+    invalid = [chem for chem in data.get("chemicals", []) if is_hallucinated_cas(chem.get("cas"))]
+    data["chemicals"] = [chem for chem in data.get("chemicals", []) if not is_hallucinated_cas(chem.get("cas"))]
+    if "limits" in data:
+        data["limits"] = [row for row in data["limits"] if not is_hallucinated_cas(row.get("cas"))]
+    return data, invalid
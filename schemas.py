@@ -0,0 +1,62 @@
+"""Structured-output schemas for the Gemini calls.
+
+Each reply comes in two shapes. The schema classes (Chemical, ChemicalList,
+RegulatoryLimit, SdsAudit) are what is sent as response_schema: google-generativeai
+0.8.3 rejects a "default" key in them, so their fields are nullable but have no
+defaults. The SDK also drops "required", so Gemini may omit any field; replies
+are therefore validated with the lenient *Reply models, where everything defaults
+to None / [] and incomplete rows are filtered downstream instead of failing the reply.
+
+Kept free of Streamlit imports so the schemas can be unit tested on their own.
+"""
+from pydantic import BaseModel
+
+class Chemical(BaseModel):
+    name: str | None
+    cas: str | None
+
+class ChemicalList(BaseModel):
+    chemicals: list[Chemical]
+
+class RegulatoryLimit(BaseModel):
+    cas: str | None
+    name: str | None
+    osha_pel: str | None
+    cal_pel: str | None
+    cal_stel: str | None
+    niosh_rel: str | None
+
+class SdsAudit(BaseModel):
+    chemicals: list[Chemical]
+    limits: list[RegulatoryLimit]
+
+class ChemicalReply(BaseModel):
+    name: str | None = None
+    cas: str | None = None
+
+class ChemicalListReply(BaseModel):
+    chemicals: list[ChemicalReply] = []
+
+class RegulatoryLimitReply(BaseModel):
+    cas: str | None = None
+    name: str | None = None
+    osha_pel: str | None = None
+    cal_pel: str | None = None
+    cal_stel: str | None = None
+    niosh_rel: str | None = None
+
+class SdsAuditReply(BaseModel):
+    chemicals: list[ChemicalReply] = []
+    limits: list[RegulatoryLimitReply] = []
+
+# response_schema -> the model its replies are validated with
+REPLY_MODELS = {
+    Chemical: ChemicalReply,
+    ChemicalList: ChemicalListReply,
+    RegulatoryLimit: RegulatoryLimitReply,
+    SdsAudit: SdsAuditReply,
+}
+
+def parse_reply(schema, raw_text):
+    """Validate a reply sent for the given response_schema, as plain dicts. Missing fields become None"""
+    return REPLY_MODELS[schema].model_validate_json(raw_text).model_dump()
@@ -0,0 +1,65 @@
+import pytest
+
+from cas_numbers import drop_invalid_cas, has_valid_check_digit, is_cas_number, normalize_cas
+
+
+@pytest.mark.parametrize("cas", ["7732-18-5", "64-17-5", "13463-67-7", "50-00-0"])
+def test_known_good_cas_numbers_pass_the_checksum(cas):
+    assert has_valid_check_digit(cas)
+    assert is_cas_number(cas)
+
+
+@pytest.mark.parametrize("cas", ["7732-18-4", "64-17-6"])
+def test_wrong_check_digit_is_rejected(cas):
+    assert not has_valid_check_digit(cas)
+    assert not is_cas_number(cas)
+
+
+@pytest.mark.parametrize("cas", ["00-00-0", "0000000-00-0"])
+def test_all_zero_placeholder_is_rejected(cas):
+    assert not is_cas_number(normalize_cas(cas))
+
+
+@pytest.mark.parametrize("cas", ["Trade Secret", "Mixture", "", None])
+def test_non_cas_text_is_not_a_cas_number(cas):
+    assert not is_cas_number(normalize_cas(cas))
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("7732-18-5", "7732-18-5"),
+    (" 7732 18 5 ", "7732-18-5"),
+    ("7732185", "7732-18-5"),
+    ("0007732-18-5", "7732-18-5"),
+    ("  Trade Secret ", "Trade Secret"),
+    (None, ""),
+])
+def test_normalize_cas(raw, expected):
+    assert normalize_cas(raw) == expected
+
+
+def test_drop_invalid_cas_keeps_valid_and_non_cas_rows():
+    data = {
+        "chemicals": [
+            {"name": "Water", "cas": "7732 18 5"},
+            {"name": "Made up", "cas": "7732-18-4"},
+            {"name": "Template", "cas": "00-00-0"},
+            {"name": "Fragrance", "cas": "Trade Secret"},
+        ],
+        "limits": [
+            {"name": "Water", "cas": "7732-18-5"},
+            {"name": "Made up", "cas": "7732-18-4"},
+        ],
+    }
+
+    data, dropped = drop_invalid_cas(data)
+
+    assert [chem["name"] for chem in data["chemicals"]] == ["Water", "Fragrance"]
+    assert [row["name"] for row in data["limits"]] == ["Water"]
+    assert [chem["name"] for chem in dropped] == ["Made up", "Template"]
+
+
+def test_drop_invalid_cas_without_limits():
+    data, dropped = drop_invalid_cas({"chemicals": [{"name": "Water", "cas": "7732-18-5"}]})
+
+    assert "limits" not in data
+    assert dropped == []
@@ -0,0 +1,35 @@
+import pytest
+from google.generativeai.types import generation_types
+
+from schemas import REPLY_MODELS, RegulatoryLimit, SdsAudit, parse_reply
+
+@pytest.mark.parametrize("schema", list(REPLY_MODELS), ids=lambda schema: schema.__name__)
+def test_schema_converts_for_gemini(schema):
+    config = generation_types.to_generation_config_dict(
+        {"response_mime_type": "application/json", "response_schema": schema}
+    )
+    assert config["response_schema"].properties
+
+@pytest.mark.parametrize("schema", list(REPLY_MODELS.values()), ids=lambda schema: schema.__name__)
+def test_reply_model_is_not_sent_to_gemini(schema):
+    # Reply models carry defaults, which the pinned SDK refuses in a response_schema
+    with pytest.raises(ValueError, match="default"):
+        generation_types.to_generation_config_dict(
+            {"response_mime_type": "application/json", "response_schema": schema}
+        )
+
+def test_missing_fields_parse_as_none():
+    assert parse_reply(RegulatoryLimit, '{"cas": "7732-18-5"}') == {
+        "cas": "7732-18-5",
+        "name": None,
+        "osha_pel": None,
+        "cal_pel": None,
+        "cal_stel": None,
+        "niosh_rel": None,
+    }
+
+def test_missing_lists_parse_as_empty():
+    assert parse_reply(SdsAudit, '{"chemicals": [{"name": "Water"}]}') == {
+        "chemicals": [{"name": "Water", "cas": None}],
+        "limits": [],
+    }